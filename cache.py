@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import sqlite3
+from typing import Optional
+
+from bip32 import BIP32
+
+CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'indy')
+COMMIT_INTERVAL = 100
+
+
+class ScriptCache:
+    """
+    On-disk cache of the scripts derived from a master key, so that re-runs don't need to derive them again.
+    """
+
+    def __init__(self, master_key: BIP32, directory: str = CACHE_DIRECTORY):
+        # only a hash of the master public key is used, so the file name doesn't reveal the key
+        fingerprint = hashlib.sha256(master_key.get_master_xpub().encode()).digest()[:8].hex()
+
+        # scripts are derived in a worker thread, but never concurrently, so the connection can be shared across threads
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, f'{fingerprint}.db'), check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS scripts ('
+            'path TEXT, type TEXT, account INT, idx INT, script BLOB, PRIMARY KEY (path, type, account, idx))'
+        )
+        self.pending = 0
+
+    def get(self, path: str, type: str, account: int, index: int) -> Optional[bytes]:
+        """
+        Fetch the script of a descriptor at a specific index and account pair, if it was cached.
+        """
+        row = self.connection.execute(
+            'SELECT script FROM scripts WHERE path = ? AND type = ? AND account = ? AND idx = ?',
+            (path, type, account, index)
+        ).fetchone()
+
+        return row[0] if row else None
+
+    def put(self, path: str, type: str, account: int, index: int, script: bytes) -> None:
+        """
+        Store the script of a descriptor at a specific index and account pair.
+        """
+        self.connection.execute(
+            'INSERT OR REPLACE INTO scripts (path, type, account, idx, script) VALUES (?, ?, ?, ?, ?)',
+            (path, type, account, index, script)
+        )
+
+        self.pending += 1
+        if self.pending >= COMMIT_INTERVAL:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self) -> None:
+        """
+        Write any pending scripts to disk and release the cache file.
+        """
+        self.connection.commit()
+        self.connection.close()
@@ -2,10 +2,11 @@
 from __future__ import annotations
 
 from collections import OrderedDict, deque
-from typing import List, Optional
+from typing import List, Optional, Tuple, Union
 
 from bip32 import BIP32, HARDENED_INDEX
 
+from cache import ScriptCache
 from scripts import ScriptType
 
 # m: master key
@@ -45,35 +46,68 @@ class Path:
 
     def __init__(self, path: str):
         self.path = path
+        self.variable_account = 'a' in path
+        self.variable_index = 'i' in path
+
+        # the levels are only parsed when they are needed, since most rendered paths (eg. the ones of used scripts) are
+        # only printed
+        self.template = None
+        self.prefix_template = None
+        self.suffix_template = None
+
+    def _parse(self) -> None:
+        """
+        Parse the levels once, as (value, hardened) pairs where the value is a number or an 'a'/'i' placeholder.
+        """
+        if self.template is not None:
+            return
+
+        template = []
+        for part in self.path.split('/')[1:]:
+            hardened = part.endswith("'")
+            value = part[:-1] if hardened else part
+            template.append((value if value in ('a', 'i') else int(value), hardened))
+
+        # levels before the index level are shared by all the indexes of an account
+        prefix_length = next((n for n, (value, _) in enumerate(template) if value == 'i'), len(template))
+        self.prefix_template = template[:prefix_length]
+        self.suffix_template = template[prefix_length:]
+
+        # set last, so that a path being parsed concurrently is never seen as parsed too early
+        self.template = template
 
     def has_variable_account(self) -> bool:
         """
         Whether this path has the account level as a free variable.
         """
-        return self.path.find('a') >= 0
+        return self.variable_account
 
     def has_variable_index(self) -> bool:
         """
         Whether this path has the index level as a free variable.
         """
-        return self.path.find('i') >= 0
+        return self.variable_index
 
     def to_list(self, index: int = None, account: int = None) -> List[int]:
         """
         Transform this path into a list of valid derivation indexes.
         """
-        # replace the placeholders
-        path = self.path.replace('a', str(account)).replace('i', str(index))
-        parts = path.split('/')[1:]
+        self._parse()
+        return _template_to_list(self.template, index, account)
 
-        # compute the derivation indexes
-        indexes = []
-        for part in parts:
-            if part.endswith("'"):
-                indexes.append(HARDENED_INDEX + int(part[:-1]))
-            else:
-                indexes.append(int(part))
-        return indexes
+    def prefix_to_list(self, account: int = None) -> List[int]:
+        """
+        Transform the levels of this path before the index level into a list of valid derivation indexes.
+        """
+        self._parse()
+        return _template_to_list(self.prefix_template, None, account)
+
+    def suffix_to_list(self, index: int = None) -> List[int]:
+        """
+        Transform the levels of this path from the index level onwards into a list of valid derivation indexes.
+        """
+        self._parse()
+        return _template_to_list(self.suffix_template, index, None)
 
     def with_account(self, account: int) -> Path:
         """
@@ -96,6 +130,16 @@ class Path:
         return hash(self.path)
 
 
+def _template_to_list(template: List[Tuple[Union[int, str], bool]], index: int, account: int) -> List[int]:
+    """
+    Transform parsed path levels into a list of valid derivation indexes, replacing the placeholders.
+    """
+    return [
+        (HARDENED_INDEX if hardened else 0) + (index if value == 'i' else account if value == 'a' else value)
+        for value, hardened in template
+    ]
+
+
 class Script:
     """
     Data needed to spend a script.
@@ -116,8 +160,55 @@ class Script:
     def full_path(self) -> Path:
         return self.path_with_account().with_index(self.index)
 
-    def set_as_used(self) -> None:
-        self.descriptor.found_used_script(self)
+    def set_as_used(self) -> int:
+        return self.descriptor.found_used_script(self)
+
+
+class KeyCache:
+    """
+    Public keys derived from a master key, shared by all the descriptors so that each derivation is only done once.
+    """
+
+    def __init__(self):
+        self.account_keys = {}
+        self.pubkeys = {}
+
+        # only the paths of several descriptors (ie. script types) can reuse a derived public key
+        self.shared_paths = {path for path, types in descriptors.items() if len(types) > 1}
+
+    def _account_key(self, master_key: BIP32, path: Path, account: int) -> BIP32:
+        """
+        Derive the extended key shared by all the indexes of an account.
+        """
+        key = (path.path, account)
+
+        if key not in self.account_keys:
+            prefix = path.prefix_to_list(account)
+
+            if master_key.master_privkey is not None:
+                chaincode, privkey = master_key.get_extended_privkey_from_path(prefix)
+                self.account_keys[key] = BIP32(chaincode, privkey=privkey, network=master_key.network)
+            else:
+                chaincode, pubkey = master_key.get_extended_pubkey_from_path(prefix)
+                self.account_keys[key] = BIP32(chaincode, pubkey=pubkey, network=master_key.network)
+
+        return self.account_keys[key]
+
+    def pubkey_at(self, master_key: BIP32, path: Path, index: int, account: int) -> bytes:
+        """
+        Derive the public key of a path at a specific index and account pair. Descriptors that share a path (but not the
+        script type) get the same public key without deriving it again.
+        """
+        if path.path not in self.shared_paths:
+            return self._account_key(master_key, path, account).get_pubkey_from_path(path.suffix_to_list(index))
+
+        key = (path.path, index, account)
+
+        if key not in self.pubkeys:
+            account_key = self._account_key(master_key, path, account)
+            self.pubkeys[key] = account_key.get_pubkey_from_path(path.suffix_to_list(index))
+
+        return self.pubkeys[key]
 
 
 class DescriptorScriptIterator:
@@ -125,7 +216,15 @@ class DescriptorScriptIterator:
     Iterator that can traverse the all the possible scripts generated by a descriptor (ie. a path and script type pair).
     """
 
-    def __init__(self, path: Path, script_type: ScriptType, address_gap: int, account_gap: int):
+    def __init__(
+            self,
+            path: Path,
+            script_type: ScriptType,
+            address_gap: int,
+            account_gap: int,
+            keys: KeyCache,
+            script_cache: Optional[ScriptCache] = None
+    ):
         self.path = path
         self.script_type = script_type
         self.address_gap = address_gap
@@ -137,14 +236,24 @@ class DescriptorScriptIterator:
         self.used_accounts = set()
         self.priority_pairs = OrderedDict()
         self.total_scripts = (self.max_index + 1) * (self.max_account + 1)
+        self.keys = keys
+        self.script_cache = script_cache
 
     def _script_at(self, master_key: BIP32, index: int, account: int) -> Script:
         """
         Render the script at a specific index and account pair.
         """
-        pubkey = master_key.get_pubkey_from_path(self.path.to_list(index, account))
+        if self.script_cache is not None:
+            script = self.script_cache.get(self.path.path, self.script_type.name, account, index)
+            if script is not None:
+                return Script(script, index, account, self)
+
+        pubkey = self.keys.pubkey_at(master_key, self.path, index, account)
         script = self.script_type.build_output_script(pubkey)
 
+        if self.script_cache is not None:
+            self.script_cache.put(self.path.path, self.script_type.name, account, index, script)
+
         return Script(script, index, account, self)
 
     def _next_pair(self) -> None:
@@ -166,27 +275,36 @@ class DescriptorScriptIterator:
         #    (0,3) (1,3) (2,3)
         #   ↙     ↙     ↙
 
-        if self.index == 0 or self.account == self.max_account:
-            # if we reached the border, start in the next diagonal
-            diagonal_total = self.index + self.account + 1
-            self.index = min(diagonal_total, self.max_index)
-            self.account = diagonal_total - self.index
-        else:
-            # go down the diagonal
-            self.index -= 1
-            self.account += 1
+        # if we reached the border, start in the next diagonal, otherwise go down the current one
+        at_border = self.index == 0 or self.account == self.max_account
+        diagonal_total = self.index + self.account + at_border
+        self.index = min(diagonal_total, self.max_index) if at_border else self.index - 1
+        self.account = diagonal_total - self.index
 
     def next_script(self, master_key: BIP32) -> Optional[Script]:
         """
         Fetch the next script for the current descriptor.
         """
-        # if there's any priority pairs, explore the first one
-        for account, indexes in list(self.priority_pairs.items()):
-            if indexes:
-                index = indexes.popleft()
-                return self._script_at(master_key, index, account)
-            else:
+        # if there's any priority pairs, explore the first one (accounts are removed as soon as they run out of pairs)
+        if self.priority_pairs:
+            account, indexes = next(iter(self.priority_pairs.items()))
+            index = indexes.popleft()
+            if not indexes:
                 del self.priority_pairs[account]
+            return self._script_at(master_key, index, account)
+
+        # with a single account (eg. the default account gap), the grid is just a linear scan of the indexes
+        if self.max_account == 0 and self.account == 0 and 0 not in self.used_accounts:
+            response = self._script_at(master_key, self.index, 0)
+            if self.index < self.max_index:
+                self.index += 1
+            else:
+                self.account = 1
+            return response
+
+        # skip the accounts that were found used since the current pair was computed, they are explored in priority
+        while self.account in self.used_accounts:
+            self._next_pair()
 
         # if we are off the grid, then we are done
         if self.account > self.max_account:
@@ -202,39 +320,42 @@ class DescriptorScriptIterator:
 
         return response
 
-    def found_used_script(self, script: Script) -> None:
+    def found_used_script(self, script: Script) -> int:
         """
-        Update the priority scripts to process, knowing that a particular script was used.
+        Update the priority scripts to process, knowing that a particular script was used. Returns the number of scripts
+        added to the total.
         """
+        previous_total_scripts = self.total_scripts
+
         # stop exploring the current account during the grid search
         self.used_accounts.add(script.account)
 
-        if script.account not in self.priority_pairs:
-            self.priority_pairs[script.account] = deque()
-
         # extend the priority list of pairs to explore with enough indexes so that the next address gap is covered
-        missing_indexes = self.priority_pairs[script.account]
+        missing_indexes = self.priority_pairs.get(script.account, deque())
         last_index = missing_indexes[-1] if missing_indexes else script.index
         new_indexes = range(last_index + 1, script.index + self.address_gap + 1)
         missing_indexes.extend(new_indexes)
-        self.total_scripts += len([i for i in new_indexes if i > self.max_index])
+        if missing_indexes:
+            self.priority_pairs[script.account] = missing_indexes
+        self.total_scripts += len(range(max(new_indexes.start, self.max_index + 1), new_indexes.stop))
 
         # extend the priority list of pairs to explore with enough accounts so that the next account gap is covered
-        while self.max_account <= script.account + self.account_gap:
+        # (paths without an account level would just repeat the same scripts for every account)
+        while self.path.has_variable_account() and self.max_account <= script.account + self.account_gap:
             self.max_account += 1
             self.total_scripts += self.max_index + 1
             current_diagonal = self.index + self.account
             missing_indexes = deque(range(current_diagonal - self.max_account))
-            self.priority_pairs[self.max_account] = missing_indexes
+            if missing_indexes:
+                self.priority_pairs[self.max_account] = missing_indexes
+
+        return self.total_scripts - previous_total_scripts
 
     def has_priority_scripts(self) -> bool:
         """
         Whether this descriptor should be prioritized because it's exploring a used account path.
         """
-        for account, indexes in self.priority_pairs.items():
-            if indexes:
-                return True
-        return False
+        return len(self.priority_pairs) > 0
 
 
 class ScriptIterator:
@@ -242,49 +363,99 @@ class ScriptIterator:
     Iterator that can traverse all the possible scripts of all the possible descriptors.
     """
 
-    def __init__(self, master_key: BIP32, address_gap: int, account_gap: int):
+    def __init__(
+            self,
+            master_key: BIP32,
+            address_gap: int,
+            account_gap: int,
+            script_cache: Optional[ScriptCache] = None
+    ):
         self.master_key = master_key
         self.index = 0
         self.descriptors = []
-        self.last_descriptor = None
+        self.exhausted_descriptors = set()
+        self.priority_descriptors = OrderedDict()
+        self.keys = KeyCache()
         for path, types in descriptors.items():
             for type in types:
-                self.descriptors.append(DescriptorScriptIterator(Path(path), type, address_gap, account_gap))
+                descriptor = DescriptorScriptIterator(
+                    Path(path), type, address_gap, account_gap, self.keys, script_cache
+                )
+                self.descriptors.append(descriptor)
+        self.total = sum(d.total_scripts for d in self.descriptors)
 
     def _next_descriptor_script(self) -> Optional[Script]:
         """
         Fetch the next script from the next descriptor.
         """
-        if self.last_descriptor and self.last_descriptor.has_priority_scripts():
-            iter = self.last_descriptor.next_script(self.master_key)
-            if iter:
-                return iter
-
-        self.last_descriptor = self.descriptors[self.index]
-        iter = self.last_descriptor.next_script(self.master_key)
+        # descriptors exploring used account paths go first, without visiting the idle ones
+        while self.priority_descriptors:
+            descriptor = next(iter(self.priority_descriptors))
+            if descriptor.has_priority_scripts():
+                return descriptor.next_script(self.master_key)
+            del self.priority_descriptors[descriptor]
+
+        descriptor = self.descriptors[self.index]
+        script = descriptor.next_script(self.master_key)
+
+        if script:
+            self.index += 1
+        else:
+            # the descriptor is exhausted: stop visiting it by moving the last descriptor (which wasn't visited yet in
+            # this cycle) into its place
+            self.exhausted_descriptors.add(descriptor)
+            last = self.descriptors.pop()
+            if self.index < len(self.descriptors):
+                self.descriptors[self.index] = last
 
-        self.index += 1
         if self.index >= len(self.descriptors):
             self.index = 0
 
-        return iter
+        return script
 
     def next_script(self) -> Optional[Script]:
         """
         Fetch the next script, cycling the descriptors in order to explore all of them progressively.
         """
-        skipped = 0
-
-        while skipped < len(self.descriptors):
+        while self.descriptors:
             iter = self._next_descriptor_script()
             if iter:
                 return iter
-            skipped += 1
 
         return None
 
+    def next_batch(self, size: int) -> List[Script]:
+        """
+        Fetch up to `size` scripts at once, with the same order as repeatedly calling `next_script`.
+        """
+        batch = []
+        while self.descriptors and len(batch) < size:
+            script = self._next_descriptor_script()
+            if script:
+                batch.append(script)
+
+        return batch
+
+    def found_used_script(self, script: Script) -> bool:
+        """
+        Mark a script as used, keeping track of the scripts that its descriptor will explore because of it. Returns
+        whether the total number of scripts to explore grew.
+        """
+        added_scripts = script.set_as_used()
+        self.total += added_scripts
+
+        if script.descriptor.has_priority_scripts():
+            self.priority_descriptors[script.descriptor] = None
+
+        # an exhausted descriptor might have new scripts to explore now
+        if script.descriptor in self.exhausted_descriptors:
+            self.exhausted_descriptors.remove(script.descriptor)
+            self.descriptors.append(script.descriptor)
+
+        return added_scripts > 0
+
     def total_scripts(self) -> int:
         """
-        Compute the total number of scripts that were or will be explored.
+        Total number of scripts that were or will be explored.
         """
-        return sum([d.total_scripts for d in self.descriptors])
+        return self.total
@@ -13,6 +13,7 @@ from mnemonic import Mnemonic
 
 import scanner
 import transactions
+from cache import ScriptCache
 
 
 def main():
@@ -21,7 +22,7 @@ def main():
                     'address format used.'
     )
 
-    parser.add_argument('key', help='master key to sweep, formats: mnemonic, xpriv or xpub')
+    parser.add_argument('key', help='master key to sweep, formats: mnemonic or xpriv')
     parser.add_argument('--passphrase', metavar='<pass>', default='',
                         help='optional secret phrase necessary to decode the mnemonic')
 
@@ -40,6 +41,8 @@ def main():
                           help='max empty addresses gap to explore (default: 20)')
     scanning.add_argument('--account-gap', metavar='<num>', default=0, type=int,
                           help='max empty account levels gap to explore (default: 0)')
+    scanning.add_argument('--cache', default=False, action='store_true',
+                          help='store the derived scripts on disk, to speed up re-runs with the same key')
 
     electrum = parser.add_argument_group('electrum server')
 
@@ -49,12 +52,19 @@ def main():
                           help='port number of the electrum server to use')
     electrum.add_argument('--protocol', choices='ts', default='s',
                           help='electrum connection protocol: t=TCP, s=SSL (default: s)')
-    electrum.add_argument('--no-batching', default=False, action='store_true',
-                          help='disable request batching')
+    electrum.add_argument('--rpc-concurrency', metavar='<num>', default=16, type=int,
+                          help='max number of concurrent requests to the electrum server (default: 16)')
 
     args = parser.parse_args()
 
-    master_key = parse_key(args.key, args.passphrase)
+    if args.rpc_concurrency < 1:
+        parser.error('argument --rpc-concurrency: must be at least 1')
+
+    try:
+        master_key = parse_key(args.key, args.passphrase)
+    except ValueError as err:
+        parser.error(str(err))
+    script_cache = ScriptCache(master_key) if args.cache else None
 
     if args.host is not None:
         port = (args.protocol + str(args.port)) if args.port else args.protocol
@@ -74,28 +84,43 @@ def main():
         args.address,
         args.fee_rate,
         args.broadcast,
-        not args.no_batching
+        args.rpc_concurrency,
+        script_cache
     ))
     loop.close()
 
+    if script_cache is not None:
+        script_cache.close()
+
 
 def parse_key(key: str, passphrase: str) -> BIP32:
     """
-    Try to parse an extended key, whether it is in xpub, xpriv or mnemonic format.
+    Try to parse a master key, whether it is in xpriv or mnemonic format.
     """
-    try:
-        private_key = BIP32.from_xpriv(key)
-        print('🔑  Read master private key successfully')
-        return private_key
-    except Exception:
-        pass
-
-    try:
-        public_key = BIP32.from_xpub(key)
-        print('🔑  Read master public key successfully')
-        return public_key
-    except Exception:
-        pass
+    # Extended keys are recognized by their version prefix (xprv, yprv, zprv, tprv, xpub, ...), since the BIP32 parser
+    # doesn't check it (and would happily read an xpub as an xpriv). Some mnemonic words share these prefixes too (eg.
+    # the czech "zprvu"), so keys that don't parse as extended keys are still tried as mnemonics.
+    key_type = key[1:4]
+
+    if key_type == 'prv':
+        try:
+            private_key = BIP32.from_xpriv(key)
+            print('🔑  Read master private key successfully')
+            return private_key
+        except Exception:
+            pass
+
+    if key_type == 'pub':
+        try:
+            BIP32.from_xpub(key)
+            is_public_key = True
+        except Exception:
+            is_public_key = False
+
+        # all the descriptors start with a hardened level, which can't be derived from a public key
+        if is_public_key:
+            raise ValueError('Master public keys can\'t be scanned, since all the known derivation paths start with a '
+                             'hardened level. Use the mnemonic or xpriv instead.')
 
     try:
         language = Mnemonic.detect_language(key)
@@ -106,7 +131,7 @@ def parse_key(key: str, passphrase: str) -> BIP32:
     except Exception:
         pass
 
-    raise ValueError('The key is invalid or the format isn\'t recognized. Make sure it\'s a mnemonic, xpriv or xpub.')
+    raise ValueError('The key is invalid or the format isn\'t recognized. Make sure it\'s a mnemonic or xpriv.')
 
 
 async def find_utxos(
@@ -117,7 +142,8 @@ async def find_utxos(
         address: Optional[str],
         fee_rate: Optional[int],
         should_broadcast: bool,
-        should_batch: bool
+        rpc_concurrency: int,
+        script_cache: Optional[ScriptCache]
 ):
     """
     Connect to an electrum server and find all the UTXOs spendable by a master key.
@@ -129,7 +155,21 @@ async def find_utxos(
 
     print('🌍  Connected to electrum server successfully')
 
-    utxos = await scanner.scan_master_key(client, master_key, address_gap, account_gap, should_batch)
+    # If we are going to sign a sweep transaction, derive the keys of the UTXOs in the background as soon as they are
+    # found, while the scan goes on
+    signing_keys = None
+    if master_key.master_privkey is not None and address is not None:
+        signing_keys = transactions.SigningKeys(master_key)
+
+    loop = asyncio.get_event_loop()
+    utxos = []
+    key_requests = []
+
+    scan = scanner.scan_master_key(client, master_key, address_gap, account_gap, rpc_concurrency, script_cache)
+    async for utxo in scan:
+        utxos.append(utxo)
+        if signing_keys is not None:
+            key_requests.append(loop.run_in_executor(None, signing_keys.keys_for, utxo.path))
 
     if len(utxos) == 0:
         print('😔  Didn\'t find any unspent outputs')
@@ -161,9 +201,11 @@ async def find_utxos(
 
         print(f'🚌  Fetched next-block fee rate of {fee_rate} sat/vbyte')
 
-    tx_without_fee = transactions.Transaction(master_key, utxos, address, balance)
+    await asyncio.gather(*key_requests)
+
+    tx_without_fee = transactions.Transaction(master_key, utxos, address, balance, signing_keys)
     fee = tx_without_fee.virtual_size() * fee_rate
-    tx = transactions.Transaction(master_key, utxos, address, balance - fee)
+    tx = transactions.Transaction(master_key, utxos, address, balance - fee, signing_keys)
     bin_tx = tx.to_bytes()
 
     print('👇  This transaction sweeps all funds to the address provided')
@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
-from typing import List, Tuple
+import asyncio
+import struct
+from collections import deque
+from typing import AsyncIterator, List, Optional, Tuple
 
 from bip32 import BIP32
 from connectrum.client import StratumClient
 from tqdm import tqdm
 
 import scripts
-from descriptors import ScriptIterator, Path
+from cache import ScriptCache
+from descriptors import ScriptIterator, Path, Script
 from scripts import ScriptType
 
-MAX_BATCH_SIZE = 100
+BATCH_SIZE = 100
 
 
 class Utxo:
@@ -21,6 +25,10 @@ class Utxo:
         self.txid = txid
         self.output_index = output_index
         self.amount_in_sat = amount_in_sat
+
+        # wire format fields, serialized once since they are needed every time a transaction spending this is serialized
+        self.outpoint = bytes.fromhex(txid)[::-1] + struct.pack('<I', output_index)
+        self.serialized_amount = struct.pack('<Q', amount_in_sat)
         self.path = path
         self.script_type = script_type
 
@@ -30,103 +38,128 @@ async def scan_master_key(
         master_key: BIP32,
         address_gap: int,
         account_gap: int,
-        should_batch: bool
-) -> List[Utxo]:
+        rpc_concurrency: int,
+        script_cache: Optional[ScriptCache] = None
+) -> AsyncIterator[Utxo]:
     """
-    Iterate through all the possible addresses of a master key, in order to find its UTXOs.
+    Iterate through all the possible addresses of a master key, in order to find its UTXOs. The UTXOs are yielded as
+    soon as they are found, while the scan goes on.
     """
-    batch_size = MAX_BATCH_SIZE if should_batch else 1
-    script_iter = ScriptIterator(master_key, address_gap, account_gap)
+    semaphore = asyncio.Semaphore(rpc_concurrency)
+    script_iter = ScriptIterator(master_key, address_gap, account_gap, script_cache)
     descriptors = set()
-    utxos = []
+    history_cache = {}
+    unspent_requests = {}
+    pending_unspent = deque()
 
-    # TODO: parallelize fetching
+    # Scripts are derived in a worker thread, so that the CPU work overlaps with the network requests
+    loop = asyncio.get_event_loop()
+    next_batch = loop.run_in_executor(None, _next_batch, script_iter, BATCH_SIZE)
 
     with tqdm(total=script_iter.total_scripts(), desc='🏃‍♀️  Searching possible addresses') as progress_bar:
         while True:
 
-            # Compute the next batch of scripts
-            scripts = []
-            for index in range(batch_size):
-                script = script_iter.next_script()
-                if not script:
-                    break
-                scripts.append(script)
-
-            if len(scripts) == 0:
-                # We are done!
-                break
-
-            # Build the next batched request
-            batch_request = []
-            for script in scripts:
-                hash = _electrum_script_hash(script.program)
-                batch_request.append(('blockchain.scripthash.get_history', hash))
-
-            responses = await _electrum_rpc(client, batch_request)
-
-            # Using the responses, compute the next batch of *used* scripts
-            used_scripts = []
-            for script, response in zip(scripts, responses):
-                if len(response) == 0:
+            # Wait for the next batch of scripts
+            scripts, hashes = await next_batch
+            done = len(scripts) == 0
+
+            # Fetch the history of the scripts we don't know yet (the unspent outputs of used scripts are requested as
+            # soon as their history arrives, without waiting for the rest of the batch)
+            new_hashes = [hash for hash in dict.fromkeys(hashes) if hash not in history_cache]
+            responses = await asyncio.gather(*[_fetch_history(client, semaphore, hash) for hash in new_hashes])
+
+            for hash, (history, unspent_request) in zip(new_hashes, responses):
+                history_cache[hash] = history
+                if unspent_request is not None:
+                    unspent_requests[hash] = unspent_request
+
+            # Using the responses, mark the *used* scripts
+            total_changed = False
+            messages = []
+            for script, hash in zip(scripts, hashes):
+                if len(history_cache[hash]) == 0:
                     continue
 
-                path, type = script.path_with_account().path, script.type().name
+                # the path is only rendered the first time a descriptor account is found used
+                descriptor = (script.descriptor, script.account)
+                if descriptor not in descriptors:
+                    descriptors.add(descriptor)
+                    path, type = script.path_with_account().path, script.type().name
+                    messages.append(f'🕵   Found used addresses at path={path} address_type={type}')
 
-                if (path, type) not in descriptors:
-                    descriptors.add((path, type))
-                    message = f'🕵   Found used addresses at path={path} address_type={type}'
-                    print(f'\r{message}'.ljust(progress_bar.ncols))  # print the message replacing the current line
+                total_changed |= script_iter.found_used_script(script)
 
-                script.set_as_used()
-                used_scripts.append(script)
+                # The unspent outputs of a script only need to be fetched (and swept) once
+                if hash in unspent_requests:
+                    pending_unspent.append((script, unspent_requests.pop(hash)))
 
-            # Build the next batched request
-            batch_request = []
-            for script in used_scripts:
-                hash = _electrum_script_hash(script.program)
-                batch_request.append(('blockchain.scripthash.listunspent', hash))
+            if not done:
+                # The next batch only depends on which scripts were used, so it can be derived (and its history
+                # fetched) while the unspent outputs of this batch are still in flight
+                next_batch = loop.run_in_executor(None, _next_batch, script_iter, BATCH_SIZE)
 
-            responses = await _electrum_rpc(client, batch_request)
+            # Collect the unspent outputs that already arrived (or all of them if we are done), in the order in which
+            # their scripts were found
+            while pending_unspent and (done or pending_unspent[0][1].done()):
+                script, unspent_request = pending_unspent.popleft()
 
-            for script, response in zip(used_scripts, responses):
-                for entry in response:
+                for entry in await unspent_request:
                     txid, output_index, amount = entry['tx_hash'], entry['tx_pos'], entry['value']
 
-                    utxo = Utxo(txid, output_index, amount, script.full_path(), script.type())
-                    utxos.append(utxo)
+                    messages.append(f'💰  Found unspent output at ({txid}, {output_index}) with {amount} sats')
+                    yield Utxo(txid, output_index, amount, script.full_path(), script.type())
+
+            # Print the messages of this batch at once, above the progress bar
+            if messages:
+                progress_bar.write('\n'.join(messages))
+
+            if done:
+                # We are done!
+                break
 
-                    message = f'💰  Found unspent output at ({txid}, {output_index}) with {amount} sats'
-                    print(f'\r{message}'.ljust(progress_bar.ncols))  # print the message replacing the current line
+            # Update the progress bar (the total only changes when a used script extends the scripts to explore)
+            if total_changed:
+                progress_bar.total = script_iter.total_scripts()
+            progress_bar.update(len(scripts))  # redraws at most every mininterval seconds
 
-            # Update the progress bar
-            progress_bar.total = script_iter.total_scripts()
-            progress_bar.update(len(scripts))
-            progress_bar.refresh()
 
-    return utxos
+def _next_batch(script_iter: ScriptIterator, batch_size: int) -> Tuple[List[Script], List[str]]:
+    """
+    Compute the next batch of scripts, along with their electrum script hashes.
+    """
+    scripts = script_iter.next_batch(batch_size)
+    return scripts, [_electrum_script_hash(script.program) for script in scripts]
 
 
 def _electrum_script_hash(script: bytes) -> str:
     """
     Compute the hex-encoded big-endian sha256 hash of a script.
     """
-    bytes = bytearray(scripts.sha256(script))
-    bytes.reverse()
-    return bytes.hex()
+    return scripts.sha256(script)[::-1].hex()
 
 
-async def _electrum_rpc(client: StratumClient, requests: List[Tuple[str, ...]]) -> List:
+async def _fetch_history(
+        client: StratumClient,
+        semaphore: asyncio.Semaphore,
+        hash: str
+) -> Tuple[List, Optional[asyncio.Future]]:
     """
-    Perform an electrum RPC call, using batching if multiple requests are required.
+    Fetch the history of a script hash and, if the script was used, start fetching its unspent outputs right away.
     """
-    if len(requests) == 0:
-        return []
+    history = await _electrum_rpc(client, semaphore, 'blockchain.scripthash.get_history', hash)
 
-    if len(requests) == 1:
-        request = requests[0]
-        response = await client.RPC(*request)
-        return [response]
+    if len(history) == 0:
+        return history, None
 
-    response = await client.batch_rpc(requests)
-    return response
+    unspent_request = asyncio.ensure_future(
+        _electrum_rpc(client, semaphore, 'blockchain.scripthash.listunspent', hash)
+    )
+    return history, unspent_request
+
+
+async def _electrum_rpc(client: StratumClient, semaphore: asyncio.Semaphore, method: str, *params):
+    """
+    Perform an electrum RPC call, limiting the number of requests in flight over the connection.
+    """
+    async with semaphore:
+        return await client.RPC(method, *params)
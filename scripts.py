@@ -17,9 +17,23 @@ P2PKH_ADDRESS_HEADER = 0x00
 P2SH_ADDRESS_HEADER = 0x05
 BECH32_HRP = 'bc'
 
-sha256 = lambda bytes: hashlib.sha256(bytes).digest()
-ripemd160 = lambda bytes: hashlib.new('ripemd160', bytes).digest()
-hash160 = lambda bytes: ripemd160(sha256(bytes))
+P2PKH_SCRIPT_SUFFIX = bytes((OP_EQUALVERIFY, OP_CHECKSIG))
+P2SH_SCRIPT_SUFFIX = bytes((OP_EQUAL,))
+
+_sha256 = hashlib.sha256
+
+sha256 = lambda data: _sha256(data).digest()
+sha256d = lambda data: _sha256(_sha256(data).digest()).digest()
+
+try:
+    hashlib.new('ripemd160')
+    ripemd160 = lambda data: hashlib.new('ripemd160', data).digest()
+except ValueError:
+    # OpenSSL 3 builds may not provide RIPEMD160, so fall back to pycryptodome's C implementation
+    from Crypto.Hash import RIPEMD160
+    ripemd160 = lambda data: RIPEMD160.new(data).digest()
+
+hash160 = lambda data: ripemd160(sha256(data))
 
 
 class ScriptType(Enum):
@@ -34,45 +48,38 @@ class ScriptType(Enum):
         """
         Compute the output script for a given public key.
         """
-        if self is ScriptType.LEGACY:
-            return _build_p2pkh_output_script(hash160(pubkey))
-
-        if self is ScriptType.COMPAT:
-            script = _build_segwit_output_script(hash160(pubkey))
-            return _build_p2sh_output_script(hash160(script))
-
-        if self is ScriptType.SEGWIT:
-            return _build_segwit_output_script(hash160(pubkey))
-
-        raise ValueError('Unrecognized address type')
+        return OUTPUT_SCRIPT_BUILDERS[self](pubkey)
 
     def build_input_script(self, pubkey: bytes, signature: bytes) -> bytes:
         """
         Compute the input script for a given public key and signature.
         """
-        if self is ScriptType.LEGACY:
-            return _build_p2pkh_input_script(pubkey, signature)
-
-        if self is ScriptType.COMPAT:
-            script = _build_segwit_output_script(hash160(pubkey))
-            return _build_p2sh_input_script(script)
-
-        if self is ScriptType.SEGWIT:
-            return bytes()
-
-        raise ValueError('Unrecognized address type')
+        return INPUT_SCRIPT_BUILDERS[self](pubkey, signature)
 
     def build_witness(self, pubkey: bytes, signature: bytes) -> List[bytes]:
         """
         Compute the witness for a given public key and signature.
         """
-        if self is ScriptType.LEGACY:
-            return []
+        return WITNESS_BUILDERS[self](pubkey, signature)
+
 
-        if self in [ScriptType.COMPAT, ScriptType.SEGWIT]:
-            return [signature, pubkey]
+OUTPUT_SCRIPT_BUILDERS = {
+    ScriptType.LEGACY: lambda pubkey: _build_p2pkh_output_script(hash160(pubkey)),
+    ScriptType.COMPAT: lambda pubkey: _build_p2sh_output_script(hash160(_build_segwit_output_script(hash160(pubkey)))),
+    ScriptType.SEGWIT: lambda pubkey: _build_segwit_output_script(hash160(pubkey)),
+}
 
-        raise ValueError('Unrecognized address type')
+INPUT_SCRIPT_BUILDERS = {
+    ScriptType.LEGACY: lambda pubkey, signature: _build_p2pkh_input_script(pubkey, signature),
+    ScriptType.COMPAT: lambda pubkey, signature: _build_p2sh_input_script(_build_segwit_output_script(hash160(pubkey))),
+    ScriptType.SEGWIT: lambda pubkey, signature: bytes(),
+}
+
+WITNESS_BUILDERS = {
+    ScriptType.LEGACY: lambda pubkey, signature: [],
+    ScriptType.COMPAT: lambda pubkey, signature: [signature, pubkey],
+    ScriptType.SEGWIT: lambda pubkey, signature: [signature, pubkey],
+}
 
 
 def build_output_script_from_address(address: str) -> Optional[bytes]:
@@ -99,7 +106,7 @@ def build_output_script_from_address(address: str) -> Optional[bytes]:
         version, hash = bech32.decode(BECH32_HRP, address)
 
         if version == 0:
-            return _build_segwit_output_script(hash)
+            return _build_segwit_output_script(bytes(hash))
 
     except ValueError:
         pass
@@ -108,55 +115,20 @@ def build_output_script_from_address(address: str) -> Optional[bytes]:
 
 
 def _build_p2pkh_output_script(pubkey_hash: bytes) -> bytes:
-    script = bytearray()
-
-    script.append(OP_DUP)
-    script.append(OP_HASH160)
-    script.append(len(pubkey_hash))
-    script.extend(pubkey_hash)
-    script.append(OP_EQUALVERIFY)
-    script.append(OP_CHECKSIG)
-
-    return bytes(script)
+    return bytes((OP_DUP, OP_HASH160, len(pubkey_hash))) + pubkey_hash + P2PKH_SCRIPT_SUFFIX
 
 
 def _build_p2sh_output_script(script_hash: bytes) -> bytes:
-    script = bytearray()
-
-    script.append(OP_HASH160)
-    script.append(len(script_hash))
-    script.extend(script_hash)
-    script.append(OP_EQUAL)
-
-    return bytes(script)
+    return bytes((OP_HASH160, len(script_hash))) + script_hash + P2SH_SCRIPT_SUFFIX
 
 
 def _build_segwit_output_script(hash: bytes) -> bytes:
-    script = bytearray()
-
-    script.append(OP_0)
-    script.append(len(hash))
-    script.extend(hash)
-
-    return bytes(script)
+    return bytes((OP_0, len(hash))) + hash
 
 
 def _build_p2pkh_input_script(pubkey: bytes, signature: bytes) -> bytes:
-    script = bytearray()
-
-    script.append(len(signature))
-    script.extend(signature)
-    script.append(len(pubkey))
-    script.extend(pubkey)
-
-    return bytes(script)
+    return bytes((len(signature),)) + signature + bytes((len(pubkey),)) + pubkey
 
 
 def _build_p2sh_input_script(*args: bytes) -> bytes:
-    script = bytearray()
-
-    for arg in args:
-        script.append(len(arg))
-        script.extend(arg)
-
-    return bytes(script)
+    return b''.join(bytes((len(arg),)) + arg for arg in args)
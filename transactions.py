@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
-from typing import List, Tuple
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
 import coincurve
 from bip32 import BIP32
 
 import scanner
 import scripts
+from descriptors import Path
 
 VERSION = 2
 SEGWIT_MARKER = 0
@@ -16,13 +19,60 @@ SIGHASH_ALL = 0x01
 
 NON_SEGWIT_DUST = 546
 
+# Precompiled little-endian encoders for the fixed-size integer fields
+PACK_UINT16 = struct.Struct('<H').pack
+PACK_UINT32 = struct.Struct('<I').pack
+PACK_UINT64 = struct.Struct('<Q').pack
+
+# Constant fields, already serialized in wire format
+SERIALIZED_VERSION = PACK_UINT32(VERSION)
+SERIALIZED_SEQUENCE = PACK_UINT32(SEQUENCE)
+SERIALIZED_LOCKTIME = PACK_UINT32(LOCKTIME)
+SERIALIZED_SIGHASH_ALL = PACK_UINT32(SIGHASH_ALL)
+SERIALIZED_SIGHASH_TYPE = bytes([SIGHASH_ALL])
+SMALL_VARINTS = [bytes([number]) for number in range(0xfd)]
+
+# Size of a serialized input with an empty script: txid, output index, script length and sequence
+EMPTY_INPUT_SIZE = 32 + 4 + 1 + 4
+
+
+class SigningKeys:
+    """
+    Keys needed to sign the inputs of a sweep transaction, derived only once per path since several UTXOs might belong
+    to the same address (and several transactions might spend the same UTXOs).
+    """
+
+    def __init__(self, master_key: BIP32):
+        self.master_key = master_key
+        self.keys = {}
+
+    def keys_for(self, path: Path) -> Tuple[coincurve.PrivateKey, bytes, bytes]:
+        """
+        Derive the private key, public key and signed script (the output script of a P2PKH output) of a path.
+        """
+        key = tuple(path.to_list())
+
+        if key not in self.keys:
+            privkey = coincurve.PrivateKey(self.master_key.get_privkey_from_path(key))
+            pubkey = privkey.public_key.format()
+            self.keys[key] = (privkey, pubkey, scripts.ScriptType.LEGACY.build_output_script(pubkey))
+
+        return self.keys[key]
+
 
 class Transaction:
     """
     Sweep transaction.
     """
 
-    def __init__(self, master_key: BIP32, utxos: List[scanner.Utxo], address: str, amount_in_sat: int):
+    def __init__(
+            self,
+            master_key: BIP32,
+            utxos: List[scanner.Utxo],
+            address: str,
+            amount_in_sat: int,
+            signing_keys: Optional[SigningKeys] = None
+    ):
         """
         Craft and sign a transaction that spends all the UTXOs and sends the requested funds to a specific address.
         """
@@ -36,32 +86,45 @@ class Transaction:
         self.outputs = [(amount_in_sat, output_script)]
         self.inputs = []
 
+        # The input being signed should have the output script of a P2PKH output, which is derived along with its keys.
+        if signing_keys is None:
+            signing_keys = SigningKeys(master_key)
+
+        # Build the inputs for signing: they should all have empty scripts, save for the input that we are signing.
+        inputs = [(utxo, b'', []) for utxo in utxos]
+
+        # The legacy digests only differ in the script of the input being signed, and the BIP143 digests of all the
+        # segwit inputs share the hashes of the outpoints, sequences and outputs.
+        legacy_template = _legacy_signing_template(inputs, self.outputs)
+        segwit_hashes = _bip143_hashes(inputs, self.outputs)
+
+        # Compute the digest that each input should sign, along with the key that signs it.
+        digests = []
         for index in range(len(utxos)):
             utxo = utxos[index]
-
-            # Build the inputs for signing: they should all have empty scripts, save for the input that we are signing,
-            # which should have the output script of a P2PKH output.
-            pubkey = master_key.get_pubkey_from_path(utxo.path.to_list())
-            script = scripts.ScriptType.LEGACY.build_output_script(pubkey)
-            inputs = [(u, script if u == utxo else b'', []) for u in utxos]
+            privkey, _, script = signing_keys.keys_for(utxo.path)
+            inputs[index] = (utxo, script, [])
 
             if utxo.script_type == scripts.ScriptType.LEGACY:
                 # If this is a legacy input, then the transaction digest is just the wire format serialization.
-                tx = _serialize_tx(inputs, self.outputs, include_witness=False)
+                tx = _serialize_tx_for_legacy_signing(index, inputs, legacy_template)
             else:
                 # If this is a segwit input (native or not), then the transaction digest is the one defined in BIP143.
-                tx = _serialize_tx_for_segwit_signing(index, inputs, self.outputs)
+                tx = _serialize_tx_for_segwit_signing(index, inputs, segwit_hashes)
 
             # To produce the final message digest we need to append the sig-hash type, and double sha256 the message.
-            tx.extend(SIGHASH_ALL.to_bytes(4, 'little'))
-            hash = scripts.sha256(scripts.sha256(bytes(tx)))
+            tx.extend(SERIALIZED_SIGHASH_ALL)
+            digests.append((privkey, scripts.sha256d(tx)))
+            inputs[index] = (utxo, b'', [])
 
-            privkey = master_key.get_privkey_from_path(utxo.path.to_list())
-            signature = coincurve.PrivateKey(privkey).sign(hash, hasher=None)
+        # The signatures are independent of each other, and libsecp256k1 signs without holding the GIL, so the inputs
+        # can be signed in parallel.
+        with ThreadPoolExecutor() as executor:
+            signatures = executor.map(lambda digest: digest[0].sign(digest[1], hasher=None), digests)
 
-            extended_signature = bytearray(signature)
-            extended_signature.append(SIGHASH_ALL)
-            extended_signature = bytes(extended_signature)
+        for utxo, signature in zip(utxos, signatures):
+            pubkey = signing_keys.keys_for(utxo.path)[1]
+            extended_signature = signature + SERIALIZED_SIGHASH_TYPE
 
             self.inputs.append((
                 utxo,
@@ -97,7 +160,7 @@ def _serialize_tx(
     segwit = include_witness and any(len(witness) > 0 for _, _, witness in inputs)
 
     tx = bytearray()
-    tx.extend(VERSION.to_bytes(4, 'little'))
+    tx.extend(SERIALIZED_VERSION)
 
     if segwit:
         tx.append(SEGWIT_MARKER)
@@ -106,18 +169,13 @@ def _serialize_tx(
     tx.extend(_varint(len(inputs)))
 
     for utxo, script, _ in inputs:
-        tx.extend(_reversed(bytes.fromhex(utxo.txid)))
-        tx.extend(utxo.output_index.to_bytes(4, 'little'))
+        tx.extend(utxo.outpoint)
         tx.extend(_varint(len(script)))
         tx.extend(script)
-        tx.extend(SEQUENCE.to_bytes(4, 'little'))
+        tx.extend(SERIALIZED_SEQUENCE)
 
     tx.extend(_varint(len(outputs)))
-
-    for amount, script in outputs:
-        tx.extend(amount.to_bytes(8, 'little'))
-        tx.extend(_varint(len(script)))
-        tx.extend(script)
+    tx.extend(_serialize_outputs(outputs))
 
     if segwit:
         for _, _, witness in inputs:
@@ -126,49 +184,105 @@ def _serialize_tx(
                 tx.extend(_varint(len(item)))
                 tx.extend(item)
 
-    tx.extend(LOCKTIME.to_bytes(4, 'little'))
+    tx.extend(SERIALIZED_LOCKTIME)
     return tx
 
 
-def _serialize_tx_for_segwit_signing(
-        input_index: int,
+def _serialize_outputs(outputs: List[Tuple[int, bytes]]) -> bytearray:
+    """
+    Serialize the outputs of a transaction in wire format, without their count.
+    """
+    outs = bytearray()
+    for amount, script in outputs:
+        outs.extend(PACK_UINT64(amount))
+        outs.extend(_varint(len(script)))
+        outs.extend(script)
+
+    return outs
+
+
+def _legacy_signing_template(
         inputs: List[Tuple[scanner.Utxo, bytes, List[bytes]]],
         outputs: List[Tuple[int, bytes]]
-) -> bytearray:
+) -> Tuple[bytes, bytes, bytes]:
     """
-    Serialize a transaction in order to produce the BIP143 digest needed to sign segwit inputs.
+    Serialize the parts of the legacy signing digests that are the same for all inputs: the header, the inputs with
+    empty scripts, and the outputs and locktime.
     """
-    tx = bytearray()
-    tx.extend(VERSION.to_bytes(4, 'little'))
+    header = SERIALIZED_VERSION + _varint(len(inputs))
+    empty_inputs = b''.join(utxo.outpoint + _varint(0) + SERIALIZED_SEQUENCE for utxo, _, _ in inputs)
+    footer = bytes(_varint(len(outputs)) + _serialize_outputs(outputs) + SERIALIZED_LOCKTIME)
 
-    outpoints = bytearray()
-    sequences = bytearray()
+    return header, empty_inputs, footer
 
-    for utxo, _, _ in inputs:
-        outpoints.extend(_reversed(bytes.fromhex(utxo.txid)))
-        outpoints.extend(utxo.output_index.to_bytes(4, 'little'))
-        sequences.extend(SEQUENCE.to_bytes(4, 'little'))
 
-    tx.extend(scripts.sha256(scripts.sha256(bytes(outpoints))))
-    tx.extend(scripts.sha256(scripts.sha256(bytes(sequences))))
+def _serialize_tx_for_legacy_signing(
+        input_index: int,
+        inputs: List[Tuple[scanner.Utxo, bytes, List[bytes]]],
+        template: Tuple[bytes, bytes, bytes]
+) -> bytearray:
+    """
+    Serialize a transaction in order to produce the digest needed to sign legacy inputs. This is the same as the wire
+    format without witnesses, but only the input being signed is serialized, the rest come from the template.
+    """
+    header, empty_inputs, footer = template
+    start, end = input_index * EMPTY_INPUT_SIZE, (input_index + 1) * EMPTY_INPUT_SIZE
 
     utxo, script, _ = inputs[input_index]
 
-    tx.extend(_reversed(bytes.fromhex(utxo.txid)))
-    tx.extend(utxo.output_index.to_bytes(4, 'little'))
+    tx = bytearray(header)
+    tx.extend(empty_inputs[:start])
+    tx.extend(utxo.outpoint)
     tx.extend(_varint(len(script)))
     tx.extend(script)
-    tx.extend(utxo.amount_in_sat.to_bytes(8, 'little'))
-    tx.extend(SEQUENCE.to_bytes(4, 'little'))
+    tx.extend(SERIALIZED_SEQUENCE)
+    tx.extend(empty_inputs[end:])
+    tx.extend(footer)
+    return tx
+
+
+def _bip143_hashes(
+        inputs: List[Tuple[scanner.Utxo, bytes, List[bytes]]],
+        outputs: List[Tuple[int, bytes]]
+) -> Tuple[bytes, bytes, bytes]:
+    """
+    Compute the hashPrevouts, hashSequence and hashOutputs fields of the BIP143 digest, which are the same for all
+    inputs.
+    """
+    outpoints = b''.join(utxo.outpoint for utxo, _, _ in inputs)
+    sequences = SERIALIZED_SEQUENCE * len(inputs)
+
+    outs = _serialize_outputs(outputs)
+
+    # hashlib reads the bytearray buffer directly, so there's no need to copy it into a bytes object first
+    return scripts.sha256d(outpoints), scripts.sha256d(sequences), scripts.sha256d(outs)
 
-    outs = bytearray()
-    for amount, script in outputs:
-        outs.extend(amount.to_bytes(8, 'little'))
-        outs.extend(_varint(len(script)))
-        outs.extend(script)
 
-    tx.extend(scripts.sha256(scripts.sha256(bytes(outs))))
-    tx.extend(LOCKTIME.to_bytes(4, 'little'))
+def _serialize_tx_for_segwit_signing(
+        input_index: int,
+        inputs: List[Tuple[scanner.Utxo, bytes, List[bytes]]],
+        hashes: Tuple[bytes, bytes, bytes]
+) -> bytearray:
+    """
+    Serialize a transaction in order to produce the BIP143 digest needed to sign segwit inputs.
+    """
+    hash_prevouts, hash_sequence, hash_outputs = hashes
+
+    tx = bytearray()
+    tx.extend(SERIALIZED_VERSION)
+    tx.extend(hash_prevouts)
+    tx.extend(hash_sequence)
+
+    utxo, script, _ = inputs[input_index]
+
+    tx.extend(utxo.outpoint)
+    tx.extend(_varint(len(script)))
+    tx.extend(script)
+    tx.extend(utxo.serialized_amount)
+    tx.extend(SERIALIZED_SEQUENCE)
+
+    tx.extend(hash_outputs)
+    tx.extend(SERIALIZED_LOCKTIME)
     return tx
 
 
@@ -177,21 +291,15 @@ def _varint(number: int) -> bytes:
     Create a script that pushes an integer to the script stack.
     """
     if number <= 0xfc:
-        return bytes([number])
+        return SMALL_VARINTS[number]
 
     if number <= 0xffff:
-        return bytes([0xfd, *number.to_bytes(2, 'little')])
+        return b'\xfd' + PACK_UINT16(number)
 
     if number <= 0xffff_ffff:
-        return bytes([0xfe, *number.to_bytes(4, 'little')])
+        return b'\xfe' + PACK_UINT32(number)
 
     if number <= 0xffff_ffff_ffff_ffff:
-        return bytes([0xff, *number.to_bytes(8, 'little')])
+        return b'\xff' + PACK_UINT64(number)
 
     raise ValueError()
-
-
-def _reversed(array: bytes) -> bytes:
-    array = bytearray(array)
-    array.reverse()
-    return bytes(array)